@@ -4,135 +4,272 @@ cbz_to_pdf_gpu.py
 ~~~~~~~~~~~~~~~~~
 Convert every .cbz file in the folder you hard-code below to PDFs that land
 next to this script.
-Now with GPU acceleration and improved memory efficiency.
+Memory efficient version with batch processing; oversized pages are resized
+to MAX_IMAGE_SIZE in batches on the GPU when CUDA is available.
 
 Edit INPUT_DIR and run:
     python cbz_to_pdf_gpu.py
 """
 
 from pathlib import Path
+import multiprocessing
+import os
 import re
+import shutil
+import tempfile
 import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from PIL import Image
-import torch
-import torchvision.transforms as transforms
-import gc
 from io import BytesIO
 
+try:
+    import img2pdf  # embeds JPEG bytes verbatim instead of re-encoding
+except ImportError:
+    img2pdf = None
+
+try:
+    from natsort import natsorted, ns  # C-accelerated natural sort
+except ImportError:
+    natsorted = None
+
+# Configure the CUDA caching allocator before torch creates its context:
+# expandable segments fight fragmentation from the varying batch shapes,
+# so blocks are reused instead of growing the pool per new shape
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True,max_split_size_mb:128")
+
+try:
+    import numpy as np
+    import torch
+    from torchvision.transforms.v2 import functional as TF
+except ImportError:
+    torch = None
+
 # >>>>>>>>>>>>>>>>>>>>>>>  EDIT THIS  <<<<<<<<<<<<<<<<<<<<<<<<<
 INPUT_DIR = r"C:\Users\azhme\OneDrive - Clear Creek ISD\Files\Other Folders\Books\Attack On Titan Manga\CBZ"
 BATCH_SIZE = 51  # Process images in batches to manage memory
+JPEG_QUALITY = 85  # Quality for the per-page JPEG encode
+MAX_IMAGE_SIZE = (1200, 1600)  # Pages larger than this get resized
 USE_GPU = True  # Set to False to disable GPU acceleration
 # >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
 
+IMG_EXTS = frozenset({".png", ".jpg", ".jpeg", ".bmp", ".gif", ".tif", ".tiff", ".webp"})
+
 # Check for CUDA availability
-device = torch.device('cuda' if USE_GPU and torch.cuda.is_available() else 'cpu')
-print(f"Using device: {device}")
+device = torch.device('cuda') if torch is not None and USE_GPU and torch.cuda.is_available() else None
+print(f"Using device: {device if device is not None else 'cpu'}")
+if device is not None:
+    # Resize batches need a fraction of the card; leave the rest alone
+    torch.cuda.set_per_process_memory_fraction(0.5)
+
+_SPLIT = re.compile(r"(\d+)")
+_natural_key_cache = {}
 
 def _natural_key(text: str):
-    """Helps sort files like page2 before page10."""
-    return [int(tok) if tok.isdigit() else tok.lower() for tok in re.split(r"(\d+)", text)]
+    """Helps sort files like page2 before page10.
 
-def process_image_gpu(img_data: bytes) -> Image.Image:
-    """Process image using GPU acceleration if available."""
-    try:
-        # Open image from bytes
-        img = Image.open(BytesIO(img_data))
-        
-        if device.type == 'cuda':
-            # Convert to tensor and move to GPU
-            transform = transforms.Compose([
-                transforms.ToTensor(),
-            ])
-            
-            tensor = transform(img).unsqueeze(0).to(device)
-            
-            # Basic GPU processing (normalize, etc.)
-            tensor = torch.clamp(tensor, 0, 1)
-            
-            # Convert back to PIL Image
-            tensor = tensor.squeeze(0).cpu()
-            img = transforms.ToPILImage()(tensor)
-        
-        # Ensure RGB mode
-        if img.mode in ("P", "RGBA"):
-            img = img.convert("RGB")
-            
-        return img
-    except Exception as e:
-        print(f"GPU processing failed, falling back to CPU: {e}")
-        # Fallback to CPU processing
-        img = Image.open(BytesIO(img_data))
-        if img.mode in ("P", "RGBA"):
-            img = img.convert("RGB")
-        return img
+    The key for each name is memoized because sorted() calls the key
+    function O(N log N) times; tuples compare faster than lists.
+    """
+    key = _natural_key_cache.get(text)
+    if key is None:
+        key = tuple(int(tok) if tok.isdigit() else tok.lower() for tok in _SPLIT.split(text))
+        _natural_key_cache[text] = key
+    return key
+
+def _to_tensor(img: Image.Image):
+    """PIL image -> uint8 CHW tensor (no float conversion, no copy)."""
+    t = torch.from_numpy(np.asarray(img))
+    return t.unsqueeze(0) if t.ndim == 2 else t.permute(2, 0, 1)
+
+def _to_image(tensor) -> Image.Image:
+    """uint8 CHW tensor -> PIL image."""
+    if tensor.shape[0] == 1:
+        return Image.fromarray(tensor[0].numpy())
+    return Image.fromarray(tensor.permute(1, 2, 0).contiguous().numpy())
+
+# Reusable staging tensors: one pinned-CPU buffer and one GPU buffer,
+# grown on demand and reused across batches and CBZs so cudaMalloc and
+# page-locking are paid once, not per page
+_staging = {"cpu": None, "gpu": None}
+
+def _staging_buffers(shape):
+    cpu_buf, gpu_buf = _staging["cpu"], _staging["gpu"]
+    if cpu_buf is None or any(have < need for have, need in zip(cpu_buf.shape, shape)):
+        if cpu_buf is not None:
+            shape = tuple(max(have, need) for have, need in zip(cpu_buf.shape, shape))
+        cpu_buf = torch.empty(shape, dtype=torch.uint8, pin_memory=True)
+        gpu_buf = torch.empty(shape, dtype=torch.uint8, device=device)
+        _staging["cpu"], _staging["gpu"] = cpu_buf, gpu_buf
+    return cpu_buf, gpu_buf
+
+def _resize_batch_gpu(imgs):
+    """Shrink decoded pages to MAX_IMAGE_SIZE on the GPU.
+
+    Pages are grouped by shape so each group costs one pinned-memory
+    upload, one batched resize kernel, and one download — never a
+    per-image round trip or a fresh per-page allocation.
+    """
+    resized = [None] * len(imgs)
+    groups = {}
+    for idx, img in enumerate(imgs):
+        groups.setdefault((img.size, img.mode), []).append(idx)
+
+    for ((w, h), mode), idxs in groups.items():
+        scale = min(MAX_IMAGE_SIZE[0] / w, MAX_IMAGE_SIZE[1] / h)
+        if scale >= 1.0:
+            for idx in idxs:
+                resized[idx] = imgs[idx]
+            continue
+
+        new_size = [max(1, round(h * scale)), max(1, round(w * scale))]
+        channels = 1 if mode == "L" else 3
+        cpu_buf, gpu_buf = _staging_buffers((len(idxs), channels, h, w))
+        stage = cpu_buf[:len(idxs), :channels, :h, :w]
+        for slot, idx in enumerate(idxs):
+            stage[slot].copy_(_to_tensor(imgs[idx]))
+
+        dev = gpu_buf[:len(idxs), :channels, :h, :w]
+        dev.copy_(stage, non_blocking=True)  # pinned source: async H2D
+        batch = TF.resize(dev, new_size, antialias=True).cpu()
+        for slot, idx in enumerate(idxs):
+            imgs[idx].close()
+            resized[idx] = _to_image(batch[slot])
+
+    return resized
+
+def _resize_batch_cpu(imgs):
+    """Fallback: per-page Lanczos thumbnail on the CPU."""
+    for img in imgs:
+        img.thumbnail(MAX_IMAGE_SIZE, Image.Resampling.LANCZOS)
+    return imgs
 
 def cbz_to_pdf(cbz_path: Path, out_dir: Path):
-    """Memory efficient CBZ to PDF conversion with GPU acceleration."""
-    with zipfile.ZipFile(cbz_path) as zf:
-        images = [n for n in zf.namelist() if n.lower().endswith((
-            ".png", ".jpg", ".jpeg", ".bmp", ".gif", ".tif", ".tiff", ".webp"
-        ))]
-        if not images:
-            print(f"[SKIP] {cbz_path.name}: no images detected")
-            return
-        images.sort(key=_natural_key)
-
-        pdf_path = out_dir / f"{cbz_path.stem}.pdf"
-        processed_images = []
-        
-        # Process images in batches
-        for i in range(0, len(images), BATCH_SIZE):
-            batch = images[i:i + BATCH_SIZE]
-            batch_processed = []
-            
-            for name in batch:
+    """Memory efficient CBZ to PDF conversion with GPU-batched resize."""
+    # With img2pdf, encoded pages spill to disk and are read back one at a
+    # time during assembly, so peak memory is one page instead of the book
+    spool_dir = tempfile.mkdtemp(prefix="cbztopdf-") if img2pdf is not None else None
+    try:
+        with zipfile.ZipFile(cbz_path) as zf:
+            # One pass over the central directory; opening by ZipInfo later
+            # skips the per-name directory lookup
+            # splitext + set lookup: only the short extension gets lowered,
+            # and membership is O(1) instead of an 8-way suffix scan
+            images = [i for i in zf.infolist()
+                      if not i.is_dir() and os.path.splitext(i.filename)[1].lower() in IMG_EXTS]
+            if not images:
+                print(f"[SKIP] {cbz_path.name}: no images detected")
+                return
+            if natsorted is not None:
+                images = natsorted(images, key=lambda i: i.filename, alg=ns.IGNORECASE)
+            else:
+                images.sort(key=lambda i: _natural_key(i.filename))
+                _natural_key_cache.clear()  # page names don't repeat across CBZs
+
+            pdf_path = out_dir / f"{cbz_path.stem}.pdf"
+            processed_images = []
+
+            def _decode_one(info):
+                """Read one page; return raw JPEG bytes or a decoded image.
+
+                JPEG pages already within MAX_IMAGE_SIZE pass straight through
+                as bytes (the header peek costs no pixel decode). Anything else
+                is decoded here and resized/encoded at the batch level.
+                """
                 try:
-                    with zf.open(name) as fp:
-                        img_data = fp.read()
-                    
-                    # Process with GPU if available
-                    processed_img = process_image_gpu(img_data)
-                    batch_processed.append(processed_img)
-                    
+                    img_data = zf.read(info)
+                    img = Image.open(BytesIO(img_data))
+                    if (img.format == "JPEG"
+                            and img.width <= MAX_IMAGE_SIZE[0]
+                            and img.height <= MAX_IMAGE_SIZE[1]):
+                        img.close()
+                        return BytesIO(img_data)
+
+                    img.load()
+                    if img.mode == "RGBA":
+                        # Composite onto white rather than convert(), which
+                        # drops the alpha channel onto black
+                        bg = Image.new("RGB", img.size, (255, 255, 255))
+                        bg.paste(img, mask=img.split()[3])
+                        img.close()
+                        img = bg
+                    elif img.mode not in ("RGB", "L"):
+                        img = img.convert("RGB")
+                    return img
                 except Exception as e:
-                    print(f"[ERROR] Failed to process {name}: {e}")
-                    continue
-            
-            processed_images.extend(batch_processed)
-            
-            # Clear GPU memory after each batch
-            if device.type == 'cuda':
-                torch.cuda.empty_cache()
-            
-            # Force garbage collection
-            gc.collect()
-            
-            print(f"Processed batch {i//BATCH_SIZE + 1}/{(len(images) + BATCH_SIZE - 1)//BATCH_SIZE}")
-
-        if not processed_images:
-            print(f"[SKIP] {cbz_path.name}: no valid images processed")
-            return
-
-        # Save PDF
-        try:
-            processed_images[0].save(
-                pdf_path, 
-                "PDF", 
-                save_all=True, 
-                append_images=processed_images[1:],
-                optimize=True,
-                quality=85
-            )
-            print(f"[OK]  {pdf_path.name} ({len(processed_images)} pages)")
-        except Exception as e:
-            print(f"[ERROR] Failed to save PDF {pdf_path.name}: {e}")
-        finally:
-            # Clean up images from memory
-            for img in processed_images:
-                img.close()
-            processed_images.clear()
-            gc.collect()
+                    print(f"[ERROR] Failed to process {info.filename}: {e}")
+                    return None
+
+            # Decode pages in parallel; results come back in submission order
+            with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+                for i in range(0, len(images), BATCH_SIZE):
+                    batch = images[i:i + BATCH_SIZE]
+                    results = [r for r in ex.map(_decode_one, batch) if r is not None]
+
+                    # Resize the decoded pages as one GPU batch, then compress
+                    # them to JPEG buffers like the pass-through pages
+                    decoded_idx = [j for j, r in enumerate(results) if isinstance(r, Image.Image)]
+                    if decoded_idx:
+                        to_resize = [results[j] for j in decoded_idx]
+                        if device is not None:
+                            resized = _resize_batch_gpu(to_resize)
+                        else:
+                            resized = _resize_batch_cpu(to_resize)
+                        for j, img in zip(decoded_idx, resized):
+                            buf = BytesIO()
+                            img.save(buf, "JPEG", quality=JPEG_QUALITY, optimize=True)
+                            img.close()
+                            buf.seek(0)
+                            results[j] = buf
+
+                    if spool_dir is not None:
+                        for buf in results:
+                            page_path = os.path.join(spool_dir, f"{len(processed_images):05d}.jpg")
+                            with open(page_path, "wb") as out:
+                                out.write(buf.getbuffer())
+                            buf.close()
+                            processed_images.append(page_path)
+                    else:
+                        processed_images.extend(results)
+
+                    print(f"Processed batch {i//BATCH_SIZE + 1}/{(len(images) + BATCH_SIZE - 1)//BATCH_SIZE}")
+
+            if not processed_images:
+                print(f"[SKIP] {cbz_path.name}: no valid images processed")
+                return
+
+            try:
+                if img2pdf is not None:
+                    # Embed the spooled JPEGs verbatim — img2pdf reads them
+                    # back one at a time and streams each page object
+                    # straight to the output file
+                    with open(pdf_path, "wb") as out:
+                        img2pdf.convert(*processed_images, outputstream=out)
+                else:
+                    # Fallback: assemble via Pillow's PDF writer; the generator
+                    # re-opens one page at a time so decoded pixels for only one
+                    # page are alive during the save
+                    # quality/optimize are not PDF-writer knobs; compression
+                    # already happened at the per-page JPEG encode
+                    first_page = Image.open(processed_images[0])
+                    first_page.save(
+                        pdf_path,
+                        "PDF",
+                        save_all=True,
+                        append_images=(Image.open(buf) for buf in processed_images[1:]),
+                    )
+                    first_page.close()
+                print(f"[OK]  {pdf_path.name} ({len(processed_images)} pages)")
+            except Exception as e:
+                print(f"[ERROR] Failed to save PDF {pdf_path.name}: {e}")
+            finally:
+                # Clean up buffers from memory
+                if spool_dir is None:
+                    for buf in processed_images:
+                        buf.close()
+                processed_images.clear()
+    finally:
+        if spool_dir is not None:
+            shutil.rmtree(spool_dir, ignore_errors=True)
 
 def main():
     source_dir = Path(INPUT_DIR).expanduser().resolve()
@@ -141,24 +278,34 @@ def main():
 
     dest_dir = Path(__file__).parent.resolve()
     print(f"Converting CBZs from {source_dir}\nSaving PDFs to {dest_dir}\n")
-    
+
     try:
-        for cbz in sorted(source_dir.glob("*.cbz"), key=lambda p: _natural_key(p.name)):
-            cbz_to_pdf(cbz, dest_dir)
-            
-            # Clean up after each file
-            if device.type == 'cuda':
-                torch.cuda.empty_cache()
-            gc.collect()
-            
+        if natsorted is not None:
+            cbz_files = natsorted(source_dir.glob("*.cbz"), key=lambda p: p.name, alg=ns.IGNORECASE)
+        else:
+            cbz_files = sorted(source_dir.glob("*.cbz"), key=lambda p: _natural_key(p.name))
+
+        # Each CBZ is independent, so spread files across processes; half
+        # the cores because every worker runs its own decode thread pool.
+        # With CUDA active, stay at two workers so the card isn't shared
+        # by more processes than the per-process memory fraction allows,
+        # and force the spawn start method: forked children inherit the
+        # parent's initialized CUDA context and cannot re-initialize it
+        if device is not None:
+            workers = 2
+            mp_context = multiprocessing.get_context("spawn")
+        else:
+            workers = max(1, (os.cpu_count() or 2) // 2)
+            mp_context = None
+        with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context) as ex:
+            futures = [ex.submit(cbz_to_pdf, cbz, dest_dir) for cbz in cbz_files]
+            for fut in futures:
+                fut.result()
+
     except KeyboardInterrupt:
         print("\nConversion interrupted by user")
     except Exception as e:
         print(f"Error during conversion: {e}")
-    finally:
-        # Final cleanup
-        if device.type == 'cuda':
-            torch.cuda.empty_cache()
 
 if __name__ == "__main__":
     main()
@@ -11,12 +11,25 @@ Edit INPUT_DIR and run:
 """
 
 from pathlib import Path
+import os
 import re
+import shutil
+import tempfile
 import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from PIL import Image
-import gc
 from io import BytesIO
 
+try:
+    import img2pdf  # embeds JPEG bytes verbatim instead of re-encoding
+except ImportError:
+    img2pdf = None
+
+try:
+    from natsort import natsorted, ns  # C-accelerated natural sort
+except ImportError:
+    natsorted = None
+
 # >>>>>>>>>>>>>>>>>>>>>>>  EDIT THIS  <<<<<<<<<<<<<<<<<<<<<<<<<
 INPUT_DIR = r"C:\Users\azhme\OneDrive - Clear Creek ISD\Files\Other Folders\Books\Attack On Titan Manga\CBZ"
 BATCH_SIZE = 5  # Process images in batches to manage memory
@@ -27,9 +40,22 @@ TARGET_DPI = 100  # Lower DPI for smaller files
 
 # ----------------------------------------------------------------
 
+IMG_EXTS = frozenset({".png", ".jpg", ".jpeg", ".bmp", ".gif", ".tif", ".tiff", ".webp"})
+
+_SPLIT = re.compile(r"(\d+)")
+_natural_key_cache = {}
+
 def _natural_key(text: str):
-    """Helps sort files like page2 before page10."""
-    return [int(tok) if tok.isdigit() else tok.lower() for tok in re.split(r"(\d+)", text)]
+    """Helps sort files like page2 before page10.
+
+    The key for each name is memoized because sorted() calls the key
+    function O(N log N) times; tuples compare faster than lists.
+    """
+    key = _natural_key_cache.get(text)
+    if key is None:
+        key = tuple(int(tok) if tok.isdigit() else tok.lower() for tok in _SPLIT.split(text))
+        _natural_key_cache[text] = key
+    return key
 
 def optimize_image(img: Image.Image) -> Image.Image:
     """Optimize image for PDF conversion to reduce file size significantly."""
@@ -38,79 +64,128 @@ def optimize_image(img: Image.Image) -> Image.Image:
         img.thumbnail(MAX_IMAGE_SIZE, Image.Resampling.LANCZOS)
     
     # Convert to RGB if needed
-    if img.mode in ("P", "RGBA"):
-        img = img.convert("RGB")
+    if img.mode == "RGBA":
+        # Composite onto white rather than convert(), which drops the
+        # alpha channel onto black
+        bg = Image.new("RGB", img.size, (255, 255, 255))
+        bg.paste(img, mask=img.split()[3])
+        img.close()
+        img = bg
     elif img.mode == "L":
         # Keep grayscale for smaller file size if it's already grayscale
         pass
-    else:
+    elif img.mode != "RGB":
         img = img.convert("RGB")
-    
+
     return img
 
 def cbz_to_pdf(cbz_path: Path, out_dir: Path):
     """Memory efficient CBZ to PDF conversion with aggressive compression."""
+    # With img2pdf, encoded pages spill to disk and are read back one at a
+    # time during assembly, so peak memory is one page instead of the book
+    spool_dir = tempfile.mkdtemp(prefix="cbztopdf-") if img2pdf is not None else None
     try:
         with zipfile.ZipFile(cbz_path, 'r') as zf:
-            images = [n for n in zf.namelist() if n.lower().endswith((
-                ".png", ".jpg", ".jpeg", ".bmp", ".gif", ".tif", ".tiff", ".webp"
-            ))]
+            # One pass over the central directory; opening by ZipInfo later
+            # skips the per-name directory lookup
+            # splitext + set lookup: only the short extension gets lowered,
+            # and membership is O(1) instead of an 8-way suffix scan
+            images = [i for i in zf.infolist()
+                      if not i.is_dir() and os.path.splitext(i.filename)[1].lower() in IMG_EXTS]
             if not images:
                 print(f"[SKIP] {cbz_path.name}: no images detected")
                 return
-            images.sort(key=_natural_key)
+            if natsorted is not None:
+                images = natsorted(images, key=lambda i: i.filename, alg=ns.IGNORECASE)
+            else:
+                images.sort(key=lambda i: _natural_key(i.filename))
+                _natural_key_cache.clear()  # page names don't repeat across CBZs
 
             pdf_path = out_dir / f"{cbz_path.stem}.pdf"
             all_pages = []
-            
-            # Process images in batches
-            for i in range(0, len(images), BATCH_SIZE):
-                batch = images[i:i + BATCH_SIZE]
-                batch_pages = []
-                
-                for name in batch:
-                    try:
-                        with zf.open(name) as fp:
-                            img_data = fp.read()
-                        
-                        # Load image from memory
-                        img = Image.open(BytesIO(img_data))
-                        img = optimize_image(img)
-                        batch_pages.append(img)
-                        
-                    except Exception as e:
-                        print(f"[WARN] Failed to process {name}: {e}")
-                        continue
-                
-                all_pages.extend(batch_pages)
-                
-                # Force garbage collection after each batch
-                gc.collect()
-                
-                print(f"Processed batch {i//BATCH_SIZE + 1}/{(len(images) + BATCH_SIZE - 1)//BATCH_SIZE} for {cbz_path.name}")
+
+            # Pick compression up front; for very large books go even lower
+            jpeg_quality = JPEG_QUALITY
+            resolution = TARGET_DPI
+            if len(images) > 50:  # Assume large file if many pages
+                jpeg_quality = 50  # Even lower quality for large files
+                resolution = 90
+
+            def _decode_one(info):
+                """Decode one page and re-encode it to compressed JPEG bytes.
+
+                Holding pre-compressed buffers instead of decoded images keeps
+                resident memory at O(pages x compressed) rather than
+                O(pages x uncompressed).
+                """
+                try:
+                    # Decode straight from the zip member — no intermediate
+                    # byte-string copy. load() must run before fp closes.
+                    with zf.open(info) as fp:
+                        img = Image.open(fp)
+                        try:
+                            # Let libjpeg decode at its native 1/2, 1/4, 1/8
+                            # scale when the source is much larger than the
+                            # target; thumbnail() finishes the residual resize
+                            img.draft("RGB", MAX_IMAGE_SIZE)
+                        except Exception:
+                            pass
+                        img.load()
+                    img = optimize_image(img)
+
+                    buf = BytesIO()
+                    img.save(buf, "JPEG", quality=jpeg_quality, optimize=True)
+                    img.close()
+                    buf.seek(0)
+                    return buf
+                except Exception as e:
+                    print(f"[WARN] Failed to process {info.filename}: {e}")
+                    return None
+
+            # Decode pages in parallel; results come back in submission order
+            with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+                for i in range(0, len(images), BATCH_SIZE):
+                    batch = images[i:i + BATCH_SIZE]
+                    batch_pages = [buf for buf in ex.map(_decode_one, batch) if buf is not None]
+
+                    if spool_dir is not None:
+                        for buf in batch_pages:
+                            page_path = os.path.join(spool_dir, f"{len(all_pages):05d}.jpg")
+                            with open(page_path, "wb") as out:
+                                out.write(buf.getbuffer())
+                            buf.close()
+                            all_pages.append(page_path)
+                    else:
+                        all_pages.extend(batch_pages)
+
+                    print(f"Processed batch {i//BATCH_SIZE + 1}/{(len(images) + BATCH_SIZE - 1)//BATCH_SIZE} for {cbz_path.name}")
 
             if not all_pages:
                 print(f"[SKIP] {cbz_path.name}: no valid images processed")
                 return
 
-            # Save PDF with aggressive compression
-            save_kwargs = {
-                "format": "PDF",
-                "save_all": True,
-                "append_images": all_pages[1:] if len(all_pages) > 1 else [],
-                "optimize": True,
-                "quality": JPEG_QUALITY,
-                "resolution": TARGET_DPI,
-                "compress_level": 9  # Maximum compression
-            }
-            
-            # For very large PDFs, try additional compression
-            if len(all_pages) > 50:  # Assume large file if many pages
-                save_kwargs["quality"] = 50  # Even lower quality for large files
-                save_kwargs["resolution"] = 90
-                
-            all_pages[0].save(pdf_path, **save_kwargs)
-            
+            if img2pdf is not None:
+                # Embed the pre-compressed JPEGs verbatim — img2pdf reads
+                # the spooled files back one at a time and streams each
+                # page object straight to the output file
+                with open(pdf_path, "wb") as out:
+                    img2pdf.convert(*all_pages, outputstream=out)
+            else:
+                # Fallback: assemble via Pillow's PDF writer; the generator
+                # re-opens one page at a time so decoded pixels for only one
+                # page are alive during the save
+                # quality/optimize/compress_level are not PDF-writer knobs;
+                # compression already happened at the per-page JPEG encode
+                first_page = Image.open(all_pages[0])
+                first_page.save(
+                    pdf_path,
+                    format="PDF",
+                    save_all=True,
+                    append_images=(Image.open(buf) for buf in all_pages[1:]),
+                    resolution=resolution,
+                )
+                first_page.close()
+
             # Check file size and warn if still large
             file_size_mb = pdf_path.stat().st_size / (1024 * 1024)
             if file_size_mb > 100:
@@ -121,11 +196,12 @@ def cbz_to_pdf(cbz_path: Path, out_dir: Path):
     except Exception as e:
         print(f"[ERROR] Failed to process {cbz_path.name}: {e}")
     finally:
-        # Clean up memory
-        if 'all_pages' in locals():
-            for img in all_pages:
-                img.close()
-        gc.collect()
+        # Clean up memory and spooled pages
+        if spool_dir is not None:
+            shutil.rmtree(spool_dir, ignore_errors=True)
+        elif 'all_pages' in locals():
+            for buf in all_pages:
+                buf.close()
 
 def main():
     source_dir = Path(INPUT_DIR).expanduser().resolve()
@@ -136,16 +212,21 @@ def main():
     print(f"Converting CBZs from {source_dir}\nSaving PDFs to {dest_dir}\n")
 
     try:
-        cbz_files = sorted(source_dir.glob("*.cbz"), key=lambda p: _natural_key(p.name))
+        if natsorted is not None:
+            cbz_files = natsorted(source_dir.glob("*.cbz"), key=lambda p: p.name, alg=ns.IGNORECASE)
+        else:
+            cbz_files = sorted(source_dir.glob("*.cbz"), key=lambda p: _natural_key(p.name))
         total_files = len(cbz_files)
-        
-        for i, cbz in enumerate(cbz_files, 1):
-            print(f"\n[{i}/{total_files}] Processing {cbz.name}")
-            cbz_to_pdf(cbz, dest_dir)
-            
-            # Memory cleanup between files
-            gc.collect()
-            
+
+        # Each CBZ is independent, so spread files across processes; half
+        # the cores because every worker runs its own decode thread pool
+        workers = max(1, (os.cpu_count() or 2) // 2)
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            futures = [ex.submit(cbz_to_pdf, cbz, dest_dir) for cbz in cbz_files]
+            for i, (cbz, fut) in enumerate(zip(cbz_files, futures), 1):
+                fut.result()
+                print(f"[{i}/{total_files}] Finished {cbz.name}")
+
     except KeyboardInterrupt:
         print("\nConversion interrupted by user")
     except Exception as e: